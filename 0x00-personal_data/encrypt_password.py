@@ -1,18 +1,55 @@
 #!/usr/bin/env python3
 """Defines encrypt_password module"""
 
+import math
+import os
+import time
+from functools import lru_cache
+from typing import Callable
+
 import bcrypt
 
 
+@lru_cache(maxsize=1)
+def target_rounds() -> int:
+    """
+    bcrypt cost factor from BCRYPT_ROUNDS, or the highest one (10 to 16)
+    hashing in at most BCRYPT_TARGET_MS (default 50) milliseconds on
+    this host, measured once (best of 5 runs after a warm-up).
+    Set BCRYPT_ROUNDS in production so that all processes agree.
+    """
+    if os.getenv('BCRYPT_ROUNDS'):
+        return int(os.getenv('BCRYPT_ROUNDS'))
+    target_ms = float(os.getenv('BCRYPT_TARGET_MS', 50))
+    salt = bcrypt.gensalt(rounds=6)
+    bcrypt.hashpw(b'calibration', salt)
+    samples = []
+    for _ in range(5):
+        start = time.perf_counter()
+        bcrypt.hashpw(b'calibration', salt)
+        samples.append(time.perf_counter() - start)
+    elapsed_ms = max(min(samples) * 1000, 1e-3)
+    rounds = 6 + math.floor(math.log2(target_ms / elapsed_ms))
+    return max(10, min(16, rounds))
+
+
 def hash_password(password: str) -> bytes:
     """Returns a salted, hashed password"""
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=target_rounds())
     return bcrypt.hashpw(password.encode(), salt)
 
 
-def is_valid(hashed_password: bytes, password: str) -> bool:
+def is_valid(hashed_password: bytes, password: str,
+             on_rehash: Callable[[bytes], None] = None) -> bool:
     """
     Validate the provided password matches
-    the hashed password.
+    the hashed password. When it does and the hash uses another cost
+    factor than target_rounds(), on_rehash is called with a new hash
+    so that the caller can persist it.
     """
-    return bcrypt.checkpw(password.encode(), hashed_password)
+    if not bcrypt.checkpw(password.encode(), hashed_password):
+        return False
+    if on_rehash is not None and \
+            int(hashed_password.split(b'$')[2]) != target_rounds():
+        on_rehash(hash_password(password))
+    return True
@@ -7,6 +7,7 @@ from api.v1.views import app_views
 from flask import Flask, jsonify, abort, request
 from flask_cors import CORS
 from typing import TypeVar
+from api.v1.auth.auth import PathMatcher
 
 
 app = Flask(__name__)
@@ -25,6 +26,9 @@ elif AUTH_TYPE == "auth":
     from api.v1.auth.auth import Auth
     auth = Auth()
 
+EXCLUDED_PATHS = PathMatcher(['/api/v1/status/', '/api/v1/unauthorized/',
+                              '/api/v1/forbidden/'])
+
 
 @app.errorhandler(404)
 def not_found(error) -> str:
@@ -51,10 +55,7 @@ def before_request_func():
     if auth is None:
         return
 
-    excluded_paths = ['/api/v1/status/', '/api/v1/unauthorized/',
-                      '/api/v1/forbidden/']
-
-    if not auth.require_auth(request.path, excluded_paths):
+    if not auth.require_auth(request.path, EXCLUDED_PATHS):
         return
 
     if auth.authorization_header(request) is None:
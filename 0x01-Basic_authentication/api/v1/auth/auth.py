@@ -2,16 +2,69 @@
 """ Auth module
 """
 from flask import request
+from functools import lru_cache
 from typing import List, TypeVar
 
 
+_PREFIX = 0
+_EXACT = 1
+
+
+class PathMatcher:
+    """
+    Excluded paths compiled into a prefix trie: a pattern ending with
+    '*' matches every path starting with the rest of it, a pattern
+    ending with '/' matches that path only. Matching costs one step
+    per character of the path, whatever the number of patterns.
+    """
+
+    def __init__(self, patterns: List[str]):
+        """Build the trie of the patterns"""
+        self._root = {}
+        self._size = 0
+        for pattern in patterns:
+            if pattern.endswith('*'):
+                key, kind = pattern[:-1], _PREFIX
+            elif pattern.endswith('/'):
+                key, kind = pattern, _EXACT
+            else:
+                continue
+            node = self._root
+            for char in key:
+                node = node.setdefault(char, {})
+            node[kind] = True
+            self._size += 1
+
+    def __len__(self) -> int:
+        """Number of compiled patterns"""
+        return self._size
+
+    def match(self, path: str) -> bool:
+        """Returns True if a pattern matches the path"""
+        node = self._root
+        for char in path:
+            if _PREFIX in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return _PREFIX in node or _EXACT in node
+
+
+@lru_cache(maxsize=32)
+def compile_paths(excluded_paths: tuple) -> PathMatcher:
+    """Returns the PathMatcher of a tuple of patterns, built once"""
+    return PathMatcher(excluded_paths)
+
+
 class Auth:
     """Class to manage the API authentication"""
 
     def require_auth(self, path: str, excluded_paths: List[str]) -> bool:
         """
         Public method that returns True if the path is not in the list
-        of strings excluded_paths.
+        of strings excluded_paths. excluded_paths can also be a
+        PathMatcher compiled once at startup.
         """
         if path is None or excluded_paths is None or len(excluded_paths) == 0:
             return True
@@ -19,14 +72,9 @@ class Auth:
         if not path.endswith('/'):
             path += '/'
 
-        for excluded_path in excluded_paths:
-            if excluded_path.endswith('*'):
-                if path.startswith(excluded_path[:-1]):
-                    return False
-            elif excluded_path.endswith('/') and path == excluded_path:
-                return False
-
-        return True
+        if not isinstance(excluded_paths, PathMatcher):
+            excluded_paths = compile_paths(tuple(excluded_paths))
+        return not excluded_paths.match(path)
 
     def authorization_header(self, request=None) -> str:
         """Public method that returns None"""
@@ -1,27 +1,149 @@
 #!/usr/bin/env python3
 """ Base module
 """
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
 from datetime import datetime
-from typing import TypeVar, List, Iterable
+from typing import TypeVar, List, Iterable, Tuple
 from os import path
+from threading import Lock, local
 import json
+import os
+import tempfile
 import uuid
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
+INDEXES = {}
+JOURNAL_SIZES = {}
+BATCH_STATE = local()
+READ_CHUNK_SIZE = 1 << 16
+FIELD_NAMES = {}
+VERSIONS = {}
+ORDERS = {}
+SAVE_LOCKS = {}
+# Read once: os.umask() can only be queried by changing it process-wide
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def _file_mode(file_path: str) -> int:
+    """ Permission bits of an existing file, or those a new file gets
+    under the umask read at import time
+    """
+    try:
+        return os.stat(file_path).st_mode & 0o777
+    except FileNotFoundError:
+        return 0o666 & ~UMASK
+
+
+def _iter_json_items(f) -> Iterable[tuple]:
+    """ Yield the (key, value) pairs of the top-level JSON object in a
+    file, reading it in chunks instead of parsing the whole document
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def read_more():
+        """ Append the next chunk of the file to the buffer
+        """
+        nonlocal buf, pos, eof
+        chunk = f.read(READ_CHUNK_SIZE)
+        buf, pos, eof = buf[pos:] + chunk, 0, chunk == ''
+
+    def next_char() -> str:
+        """ Skip whitespace and return the next character, '' at EOF
+        """
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            read_more()
+
+    def next_value():
+        """ Decode the next JSON value, reading more if it's cut off
+        """
+        nonlocal pos
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read_more()
+
+    if next_char() == '':
+        return
+    if next_char() != '{':
+        raise ValueError("Expected '{'")
+    pos += 1
+    if next_char() == '}':
+        return
+    while True:
+        key = next_value()
+        if next_char() != ':':
+            raise ValueError("Expected ':'")
+        pos += 1
+        yield key, next_value()
+        char = next_char()
+        pos += 1
+        if char == '}':
+            return
+        if char != ',':
+            raise ValueError("Expected ',' or '}'")
 
 
 class Base():
     """ Base class
+
+    Subclasses can declare secondary indexes on attribute names:
+      - `unique_attributes`: at most one object per value
+      - `indexed_attributes`: any number of objects per value
+    Equality searches on indexed attributes are dict lookups
+    instead of full scans of DATA.
+
+    When `journaled` is set, save() and remove() append one record to
+    `.db_<Class>.journal` instead of rewriting `.db_<Class>.json`; the
+    snapshot is rewritten once the journal holds `journal_threshold`
+    records.
+
+    Inside `Base.batch()`, persistence is deferred and each touched
+    class is written once when the outermost batch exits.
+
+    load_from_file() keeps the raw JSON dict of each object in DATA;
+    the instance (and its parsed datetimes) is built the first time the
+    object is returned by get(), search() or all().
+
+    Attributes live in fixed `__slots__`; subclasses declare their own
+    fields the same way. Attributes set outside the declared slots go
+    to the `_extra` dict, which is only created when needed.
+
+    to_json() results are cached per object until an attribute is set,
+    and version() changes whenever a stored object of the class does.
     """
+    __slots__ = ('id', 'created_at', 'updated_at', '_extra', '_json_cache')
+    _internal_slots = ('_extra', '_json_cache')
+    unique_attributes = ()
+    indexed_attributes = ()
+    journaled = False
+    journal_threshold = 1000
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
+        object.__setattr__(self, '_json_cache', None)
         s_class = str(self.__class__.__name__)
         if DATA.get(s_class) is None:
             DATA[s_class] = {}
+        if INDEXES.get(s_class) is None:
+            self.__class__._reset_indexes()
 
         self.id = kwargs.get('id', str(uuid.uuid4()))
         if kwargs.get('created_at') is not None:
@@ -35,6 +157,43 @@ class Base():
         else:
             self.updated_at = datetime.utcnow()
 
+    def __setattr__(self, name: str, value):
+        """ Set an attribute and keep the indexes in sync
+        """
+        cls = self.__class__
+        object.__setattr__(self, '_json_cache', None)
+        stored = self._is_stored()
+        if stored:
+            cls._touch()
+        if name not in cls._index_names() or not stored:
+            self._set_attribute(name, value)
+            return
+        cls._unindex(name, self.id, getattr(self, name, None))
+        self._set_attribute(name, value)
+        cls._index(name, self.id, value)
+
+    def __getattr__(self, name: str):
+        """ Look up an attribute set outside of the declared slots
+        """
+        if name != '_extra':
+            extra = getattr(self, '_extra', None)
+            if extra is not None and name in extra:
+                return extra[name]
+        raise AttributeError("'{}' object has no attribute '{}'"
+                             .format(self.__class__.__name__, name))
+
+    def _set_attribute(self, name: str, value):
+        """ Set a slot, or an entry of `_extra` for undeclared names
+        """
+        try:
+            object.__setattr__(self, name, value)
+        except AttributeError:
+            if hasattr(self.__class__, name):
+                raise
+            if getattr(self, '_extra', None) is None:
+                object.__setattr__(self, '_extra', {})
+            self._extra[name] = value
+
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
         """
@@ -47,59 +206,244 @@ class Base():
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
+        if self._json_cache is None:
+            object.__setattr__(self, '_json_cache', {})
+        cached = self._json_cache.get(for_serialization)
+        if cached is not None:
+            return dict(cached)
         result = {}
-        for key, value in self.__dict__.items():
+        for key, value in self._attributes():
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
                 result[key] = value.strftime(TIMESTAMP_FORMAT)
             else:
                 result[key] = value
-        return result
+        self._json_cache[for_serialization] = result
+        return dict(result)
+
+    def to_dict(self) -> dict:
+        """ Convert the object to the dictionary returned by the API
+        """
+        return self.to_json()
+
+    def _attributes(self) -> Iterable[tuple]:
+        """ Yield the (name, value) pairs of all set attributes
+        """
+        for name in self.__class__._field_names():
+            try:
+                yield name, object.__getattribute__(self, name)
+            except AttributeError:
+                continue
+        extra = getattr(self, '_extra', None)
+        if extra is not None:
+            yield from extra.items()
+
+    @classmethod
+    def _field_names(cls) -> tuple:
+        """ Names of the slots declared by the class and its parents
+        """
+        names = FIELD_NAMES.get(cls)
+        if names is None:
+            names = tuple(name for klass in reversed(cls.__mro__)
+                          for name in klass.__dict__.get('__slots__', ())
+                          if name not in cls._internal_slots)
+            FIELD_NAMES[cls] = names
+        return names
 
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from file, then replay the journal
+
+        Records are parsed incrementally and kept as raw dicts until
+        they are first accessed.
         """
         s_class = cls.__name__
         file_path = ".db_{}.json".format(s_class)
         DATA[s_class] = {}
-        if not path.exists(file_path):
-            return
-
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+        JOURNAL_SIZES[s_class] = 0
+        cls._reset_indexes()
+        cls._touch()
+        ORDERS.pop(s_class, None)
+        if path.exists(file_path):
+            with open(file_path, 'r') as f:
+                for obj_id, obj_json in _iter_json_items(f):
+                    cls._store(obj_id, obj_json)
+        cls._replay_journal()
 
     @classmethod
     def save_to_file(cls):
-        """ Save all objects to file
+        """ Save all objects to file and truncate the journal
+
+        The snapshot is written to a temporary file, fsynced and renamed
+        over the previous one, so a crash never leaves a partial file.
         """
         s_class = cls.__name__
         file_path = ".db_{}.json".format(s_class)
         objs_json = {}
         for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+            if type(obj) is dict:
+                objs_json[obj_id] = obj
+            else:
+                objs_json[obj_id] = obj.to_json(True)
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+        fd, tmp_path = tempfile.mkstemp(prefix=file_path + ".", dir=".")
+        try:
+            # mkstemp creates the file 0600: keep the previous mode
+            os.fchmod(fd, _file_mode(file_path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(objs_json, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if path.exists(cls._journal_path()):
+            os.remove(cls._journal_path())
+        JOURNAL_SIZES[s_class] = 0
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """ Defer persistence of save()/remove() made by the current
+        thread until its outermost batch exits, then write each touched
+        class once
+        """
+        if getattr(BATCH_STATE, 'depth', 0) == 0:
+            BATCH_STATE.depth = 0
+            BATCH_STATE.pending = set()
+        BATCH_STATE.depth += 1
+        try:
+            yield
+        finally:
+            BATCH_STATE.depth -= 1
+            if BATCH_STATE.depth == 0:
+                while BATCH_STATE.pending:
+                    BATCH_STATE.pending.pop().save_to_file()
 
     def save(self):
         """ Save current object
+
+        The uniqueness check and the insertion in DATA and the indexes
+        happen under a per-class lock, so concurrent saves can't both
+        claim the same unique value.
         """
-        s_class = self.__class__.__name__
-        self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        with SAVE_LOCKS.setdefault(self.__class__.__name__, Lock()):
+            self._check_unique()
+            self.updated_at = datetime.utcnow()
+            if not self._is_stored():
+                self.__class__._store(self.id, self)
+        self.__class__._persist({
+            'op': 'save', 'id': self.id, 'obj': self.to_json(True)
+        })
 
     def remove(self):
         """ Remove object
         """
         s_class = self.__class__.__name__
         if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+            self.__class__._discard(self.id)
+            self.__class__._persist({'op': 'remove', 'id': self.id})
+
+    @classmethod
+    def _persist(cls, record: dict):
+        """ Persist one mutation according to the storage mode
+        """
+        if getattr(BATCH_STATE, 'depth', 0) > 0:
+            BATCH_STATE.pending.add(cls)
+        elif cls.journaled:
+            cls._append_journal(record)
+        else:
+            cls.save_to_file()
+
+    @classmethod
+    def _store(cls, obj_id: str, obj):
+        """ Put an object or its raw dict in DATA, replacing any object
+        with the same id
+        """
+        old = DATA[cls.__name__].get(obj_id)
+        cls._touch()
+        order = ORDERS.get(cls.__name__)
+        if old is None and order is not None:
+            insort(order, obj_id)
+        for name in cls._index_names():
+            if old is not None:
+                cls._unindex(name, obj_id, cls._value_of(old, name))
+            cls._index(name, obj_id, cls._value_of(obj, name))
+        DATA[cls.__name__][obj_id] = obj
+
+    @classmethod
+    def _discard(cls, obj_id: str):
+        """ Remove an object from DATA by id
+        """
+        old = DATA[cls.__name__].pop(obj_id, None)
+        if old is None:
+            return
+        cls._touch()
+        order = ORDERS.get(cls.__name__)
+        if order is not None:
+            del order[bisect_left(order, obj_id)]
+        for name in cls._index_names():
+            cls._unindex(name, obj_id, cls._value_of(old, name))
+
+    @classmethod
+    def version(cls) -> int:
+        """ Counter that changes whenever an object of the class is
+        stored, removed or modified
+        """
+        return VERSIONS.get(cls.__name__, 0)
+
+    @classmethod
+    def _touch(cls):
+        """ Record a change to the objects of the class
+        """
+        VERSIONS[cls.__name__] = VERSIONS.get(cls.__name__, 0) + 1
+
+    @classmethod
+    def _journal_path(cls) -> str:
+        """ Path of the journal file of the class
+        """
+        return ".db_{}.journal".format(cls.__name__)
+
+    @classmethod
+    def _append_journal(cls, record: dict):
+        """ Append one mutation to the journal, compacting it into
+        the snapshot file once it reaches `journal_threshold` records
+        """
+        s_class = cls.__name__
+        with open(cls._journal_path(), 'a') as f:
+            f.write(json.dumps(record) + "\n")
+        JOURNAL_SIZES[s_class] = JOURNAL_SIZES.get(s_class, 0) + 1
+        if JOURNAL_SIZES[s_class] >= cls.journal_threshold:
+            cls.save_to_file()
+
+    @classmethod
+    def _replay_journal(cls):
+        """ Apply the journal records on top of the loaded snapshot
+        """
+        s_class = cls.__name__
+        if not path.exists(cls._journal_path()):
+            return
+        torn = False
+        with open(cls._journal_path(), 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn last record from an interrupted append: fold
+                    # the valid records into the snapshot so new appends
+                    # don't land after the partial line
+                    torn = True
+                    break
+                if record['op'] == 'save':
+                    cls._store(record['id'], record['obj'])
+                elif record['op'] == 'remove':
+                    cls._discard(record['id'])
+                JOURNAL_SIZES[s_class] += 1
+        if torn:
+            cls.save_to_file()
 
     @classmethod
     def count(cls) -> int:
@@ -112,20 +456,61 @@ class Base():
     def all(cls) -> Iterable[TypeVar('Base')]:
         """ Return all objects
         """
-        return cls.search()
+        return list(cls.iter_all())
+
+    @classmethod
+    def iter_all(cls) -> Iterable[TypeVar('Base')]:
+        """ Iterate over all objects without building a list of them
+        """
+        for obj_id in list(DATA[cls.__name__]):
+            obj = cls._materialize(obj_id)
+            if obj is not None:
+                yield obj
+
+    @classmethod
+    def page(cls, limit: int,
+             cursor: str = None) -> Tuple[List[TypeVar('Base')], str]:
+        """ Return up to `limit` objects ordered by id, starting after
+        the id `cursor`, and the cursor of the next page (None on the
+        last page)
+        """
+        s_class = cls.__name__
+        order = ORDERS.get(s_class)
+        if order is None:
+            order = sorted(DATA[s_class])
+            ORDERS[s_class] = order
+        start = 0 if cursor is None else bisect_right(order, cursor)
+        ids = order[start:start + limit]
+        next_cursor = None
+        if start + limit < len(order):
+            next_cursor = ids[-1]
+        return [cls._materialize(obj_id) for obj_id in ids], next_cursor
 
     @classmethod
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
-        s_class = cls.__name__
-        return DATA[s_class].get(id)
+        return cls._materialize(id)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
         s_class = cls.__name__
+        attributes = dict(attributes)
+        for name in cls._index_names():
+            if name not in attributes:
+                continue
+            try:
+                ids = INDEXES[s_class][name].get(attributes[name], {})
+            except TypeError:
+                continue
+            del attributes[name]
+            objs = list(ids)
+            break
+        else:
+            objs = list(DATA[s_class])
+
         def _search(obj):
             if len(attributes) == 0:
                 return True
@@ -133,5 +518,80 @@ class Base():
                 if (getattr(obj, k) != v):
                     return False
             return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+
+        return list(filter(_search, map(cls._materialize, objs)))
+
+    @classmethod
+    def _materialize(cls, obj_id: str) -> TypeVar('Base'):
+        """ Return the stored object, building it from its raw dict
+        on first access
+        """
+        obj = DATA[cls.__name__].get(obj_id)
+        if type(obj) is dict:
+            obj = cls(**obj)
+            DATA[cls.__name__][obj_id] = obj
+        return obj
+
+    @staticmethod
+    def _value_of(obj, name: str):
+        """ Value of an attribute of an object or of its raw dict
+        """
+        if type(obj) is dict:
+            return obj.get(name)
+        return getattr(obj, name, None)
+
+    @classmethod
+    def _index_names(cls) -> tuple:
+        """ Names of all indexed attributes of the class
+        """
+        return tuple(cls.unique_attributes) + tuple(cls.indexed_attributes)
+
+    @classmethod
+    def _reset_indexes(cls):
+        """ Create empty indexes for the class
+        """
+        INDEXES[cls.__name__] = {name: {} for name in cls._index_names()}
+
+    def _is_stored(self) -> bool:
+        """ True if this instance is the one referenced in DATA
+        """
+        s_class = self.__class__.__name__
+        obj_id = getattr(self, 'id', None)
+        return DATA.get(s_class, {}).get(obj_id) is self
+
+    @classmethod
+    def _index(cls, name: str, obj_id: str, value):
+        """ Add an attribute value of an object to its index
+        """
+        try:
+            INDEXES[cls.__name__][name].setdefault(value, {})[obj_id] = True
+        except TypeError:
+            pass
+
+    @classmethod
+    def _unindex(cls, name: str, obj_id: str, value):
+        """ Remove an attribute value of an object from its index
+        """
+        index = INDEXES[cls.__name__][name]
+        try:
+            ids = index.get(value, {})
+        except TypeError:
+            return
+        ids.pop(obj_id, None)
+        if len(ids) == 0:
+            index.pop(value, None)
+
+    def _check_unique(self):
+        """ Raise a ValueError if a unique attribute is already taken
+        """
+        index = INDEXES[self.__class__.__name__]
+        for name in self.unique_attributes:
+            value = getattr(self, name, None)
+            if value is None:
+                continue
+            try:
+                ids = index[name].get(value, {})
+            except TypeError:
+                continue
+            if any(obj_id != self.id for obj_id in ids):
+                raise ValueError("{} {} already exists".format(name, value))
@@ -7,6 +7,7 @@ from api.v1.views import app_views
 from flask import Flask, jsonify, abort, request
 from flask_cors import CORS
 from models.user import User
+from api.v1.auth.auth import PathMatcher
 
 
 app = Flask(__name__)
@@ -26,6 +27,13 @@ elif AUTH_TYPE == "auth":
     from api.v1.auth.auth import Auth
     auth = Auth()
 
+EXCLUDED_PATHS = PathMatcher([
+    '/api/v1/status/',
+    '/api/v1/unauthorized/',
+    '/api/v1/forbidden/',
+    '/api/v1/auth_session/login/'
+])
+
 
 @app.errorhandler(404)
 def not_found(error) -> str:
@@ -48,26 +56,24 @@ def forbidden(error) -> str:
 
 @app.before_request
 def before_request_func():
-    """Filter each request before processing"""
+    """Filter each request before processing
+
+    The user is resolved at most once, only for paths requiring
+    authentication, and kept in request.current_user for the views
+    """
+    request.current_user = None
     if auth is None:
         return
 
-    request.current_user = auth.current_user(request)
-    excluded_paths = [
-        '/api/v1/status/',
-        '/api/v1/unauthorized/',
-        '/api/v1/forbidden/',
-        '/api/v1/auth_session/login/'
-    ]
-
-    if not auth.require_auth(request.path, excluded_paths):
+    if not auth.require_auth(request.path, EXCLUDED_PATHS):
         return
     if (
         auth.authorization_header(request) is None and
         auth.session_cookie(request) is None
     ):
         abort(401)
-    if auth.current_user(request) is None:
+    request.current_user = auth.current_user(request)
+    if request.current_user is None:
         abort(403)
 
 
@@ -2,13 +2,31 @@
 """ BasicAuth module
 """
 import base64
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
 from typing import TypeVar
 from api.v1.auth.auth import Auth
 from models.user import User
 
 
 class BasicAuth(Auth):
-    """BasicAuth class that inherites from Auth"""
+    """BasicAuth class that inherites from Auth
+
+    Verified Authorization headers are cached, keyed by their HMAC with
+    a per-process secret, for `credentials_cache_ttl` seconds and up to
+    `credentials_cache_size` entries. A cached entry is dropped when the
+    user is removed or saved since, or when their password changed.
+    """
+    credentials_cache_size = 1024
+    credentials_cache_ttl = 300
+    _credentials_cache = OrderedDict()
+    _credentials_lock = Lock()
+    _credentials_key = os.urandom(32)
+
     def extract_base64_authorization_header(self,
                                             authorization_header: str) -> str:
         """
@@ -69,6 +87,37 @@ class BasicAuth(Auth):
             return None
         return user
 
+    def cached_user(self, digest: bytes) -> TypeVar('User'):
+        """
+        Returns the User cached for a header digest if the entry is
+        still valid.
+        """
+        with self._credentials_lock:
+            entry = self._credentials_cache.get(digest)
+        if entry is None:
+            return None
+        user_id, password, updated_at, expires_at = entry
+        user = User.get(user_id)
+        if time.monotonic() > expires_at or user is None or \
+                user.password != password or user.updated_at != updated_at:
+            with self._credentials_lock:
+                self._credentials_cache.pop(digest, None)
+            return None
+        with self._credentials_lock:
+            if digest in self._credentials_cache:
+                self._credentials_cache.move_to_end(digest)
+        return user
+
+    def cache_user(self, digest: bytes, user: TypeVar('User')):
+        """Caches the User verified for a header digest"""
+        expires_at = time.monotonic() + self.credentials_cache_ttl
+        with self._credentials_lock:
+            self._credentials_cache[digest] = (user.id, user.password,
+                                               user.updated_at, expires_at)
+            self._credentials_cache.move_to_end(digest)
+            while len(self._credentials_cache) > self.credentials_cache_size:
+                self._credentials_cache.popitem(last=False)
+
     def current_user(self, request=None) -> TypeVar('User'):
         """Retrieves the User instance for a request"""
         if request is None:
@@ -76,6 +125,11 @@ class BasicAuth(Auth):
         auth_header = self.authorization_header(request)
         if auth_header is None:
             return None
+        digest = hmac.new(self._credentials_key, auth_header.encode(),
+                          hashlib.sha256).digest()
+        user = self.cached_user(digest)
+        if user is not None:
+            return user
         base64_auth = self.extract_base64_authorization_header(auth_header)
         if base64_auth is None:
             return None
@@ -85,4 +139,7 @@ class BasicAuth(Auth):
         email, password = self.extract_user_credentials(decoded_auth)
         if email is None or password is None:
             return None
-        return self.user_object_from_credentials(email, password)
+        user = self.user_object_from_credentials(email, password)
+        if user is not None:
+            self.cache_user(digest, user)
+        return user
@@ -3,12 +3,17 @@
 """
 import uuid
 from api.v1.auth.auth import Auth
+from api.v1.auth.session_store import session_store_from_env
 from models.user import User
 
 
 class SessionAuth(Auth):
-    """SessionAuth class that inherites from Auth"""
-    user_id_by_session_id = {}
+    """SessionAuth class that inherites from Auth
+
+    Sessions are kept in `user_id_by_session_id`, a session store
+    shared by all instances (see api.v1.auth.session_store).
+    """
+    user_id_by_session_id = session_store_from_env()
 
     def create_session(self, user_id: str = None) -> str:
         """ Creates a Session ID for a user_id
@@ -30,7 +35,7 @@ class SessionAuth(Auth):
         """ Returns a User instance based on
         a cookie value
         """
-        session_id = self.session_ccokie(request)
+        session_id = self.session_cookie(request)
         if session_id is None:
             return None
         user_id = self.user_id_for_session_id(session_id)
@@ -46,7 +51,4 @@ class SessionAuth(Auth):
         session_id = self.session_cookie(request)
         if session_id is None:
             return False
-        if not self.user_id_for_session_id(session_id):
-            return False
-        del self.user_id_by_session_id[session_id]
-        return True
+        return self.user_id_by_session_id.pop(session_id) is not None
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+""" Session store module
+"""
+from collections import OrderedDict
+from os import getenv
+from threading import Lock, local
+import mmap
+import os
+import sqlite3
+import struct
+import time
+
+
+class _Shard:
+    """ One lock-protected part of a MemorySessionStore
+    """
+
+    def __init__(self, max_size: int):
+        """ Initialize an empty shard
+        """
+        self.lock = Lock()
+        self.sessions = OrderedDict()
+        self.max_size = max_size
+        self.next_sweep = 0
+
+
+class MemorySessionStore:
+    """ In-process session store mapping session IDs to user IDs
+
+    Sessions expire `duration` seconds after creation and
+    `idle_duration` seconds after their last lookup (0 disables either
+    limit). Expired sessions are dropped when looked up and by a sweep
+    of each shard every `sweep_interval` seconds. With `max_size`, the
+    least recently used sessions are evicted first. Sessions are spread
+    over `shards` independently locked shards.
+    """
+
+    def __init__(self, duration: int = 0, idle_duration: int = 0,
+                 max_size: int = 0, shards: int = 16,
+                 sweep_interval: int = 60):
+        """ Initialize an empty store
+        """
+        self.duration = duration
+        self.idle_duration = idle_duration
+        self.sweep_interval = sweep_interval
+        shards = max(1, shards)
+        shard_size = max(1, max_size // shards) if max_size > 0 else 0
+        self._shards = [_Shard(shard_size) for _ in range(shards)]
+
+    def _shard(self, session_id: str) -> _Shard:
+        """ Shard holding a session ID
+        """
+        return self._shards[hash(session_id) % len(self._shards)]
+
+    def _expired(self, entry: list, now: float) -> bool:
+        """ True if a [user_id, created_at, last_seen] entry expired
+        """
+        if self.duration > 0 and now - entry[1] > self.duration:
+            return True
+        if self.idle_duration > 0 and now - entry[2] > self.idle_duration:
+            return True
+        return False
+
+    def _sweep(self, shard: _Shard, now: float):
+        """ Drop the expired sessions of a shard if a sweep is due;
+        the shard lock must be held
+        """
+        if now < shard.next_sweep:
+            return
+        shard.next_sweep = now + self.sweep_interval
+        if self.duration <= 0 and self.idle_duration <= 0:
+            return
+        expired = [session_id for session_id, entry
+                   in shard.sessions.items() if self._expired(entry, now)]
+        for session_id in expired:
+            del shard.sessions[session_id]
+
+    def __setitem__(self, session_id: str, user_id: str):
+        """ Store a new session
+        """
+        shard = self._shard(session_id)
+        now = time.monotonic()
+        with shard.lock:
+            self._sweep(shard, now)
+            shard.sessions[session_id] = [user_id, now, now]
+            shard.sessions.move_to_end(session_id)
+            if shard.max_size > 0:
+                while len(shard.sessions) > shard.max_size:
+                    shard.sessions.popitem(last=False)
+
+    def get(self, session_id: str, default: str = None) -> str:
+        """ User ID of a live session, refreshing its idle timer
+        """
+        shard = self._shard(session_id)
+        now = time.monotonic()
+        with shard.lock:
+            self._sweep(shard, now)
+            entry = shard.sessions.get(session_id)
+            if entry is None:
+                return default
+            if self._expired(entry, now):
+                del shard.sessions[session_id]
+                return default
+            entry[2] = now
+            shard.sessions.move_to_end(session_id)
+            return entry[0]
+
+    def pop(self, session_id: str, default: str = None) -> str:
+        """ Remove a session and return its user ID if it was live
+        """
+        shard = self._shard(session_id)
+        with shard.lock:
+            entry = shard.sessions.pop(session_id, None)
+        if entry is None or self._expired(entry, time.monotonic()):
+            return default
+        return entry[0]
+
+    def __getitem__(self, session_id: str) -> str:
+        """ User ID of a live session, KeyError if there is none
+        """
+        user_id = self.get(session_id)
+        if user_id is None:
+            raise KeyError(session_id)
+        return user_id
+
+    def __delitem__(self, session_id: str):
+        """ Remove a session, KeyError if there is none
+        """
+        if self.pop(session_id) is None:
+            raise KeyError(session_id)
+
+    def __contains__(self, session_id: str) -> bool:
+        """ True if the session is live
+        """
+        return self.get(session_id) is not None
+
+    def __len__(self) -> int:
+        """ Number of stored sessions, including expired ones not yet
+        swept
+        """
+        return sum(len(shard.sessions) for shard in self._shards)
+
+    def purge(self):
+        """ Drop all expired sessions now
+        """
+        now = time.monotonic()
+        for shard in self._shards:
+            with shard.lock:
+                shard.next_sweep = 0
+                self._sweep(shard, now)
+
+
+class SQLiteSessionStore:
+    """ Session store in a SQLite database (WAL mode) shared by all the
+    worker processes of a host
+
+    Each process keeps an LRU cache of up to `cache_size` sessions.
+    Deleting a session bumps a generation counter kept in the
+    memory-mapped file `<db_path>.gen`; a process seeing a new
+    generation drops its cache, so lookups of cached sessions never hit
+    the database. Expiry follows MemorySessionStore: `duration` and
+    `idle_duration` seconds, 0 disabling either. The last lookup time
+    is written back at most every `touch_interval` seconds.
+    """
+
+    def __init__(self, db_path: str, duration: int = 0,
+                 idle_duration: int = 0, cache_size: int = 10000,
+                 touch_interval: int = None):
+        """ Open (and create if needed) the database at db_path
+        """
+        self.db_path = db_path
+        self.duration = duration
+        self.idle_duration = idle_duration
+        self.cache_size = cache_size
+        if touch_interval is None:
+            touch_interval = idle_duration // 10
+        self.touch_interval = touch_interval
+        self._local = local()
+        self._lock = Lock()
+        self._cache = OrderedDict()
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                     "session_id TEXT PRIMARY KEY, user_id TEXT NOT NULL, "
+                     "created_at REAL NOT NULL, last_seen REAL NOT NULL)")
+        conn.commit()
+        fd = os.open(db_path + ".gen", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < 8:
+                os.ftruncate(fd, 8)
+            self._generation_map = mmap.mmap(fd, 8)
+        finally:
+            os.close(fd)
+        self._generation = self._read_generation()
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Connection of the current thread and process
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _read_generation(self) -> int:
+        """ Current value of the shared generation counter
+        """
+        return struct.unpack_from('<Q', self._generation_map)[0]
+
+    def _check_generation(self):
+        """ Drop the cache if a session was deleted by any process
+        """
+        generation = self._read_generation()
+        if generation != self._generation:
+            with self._lock:
+                self._cache.clear()
+                self._generation = generation
+
+    def _expired(self, entry: list, now: float) -> bool:
+        """ True if a [user_id, created_at, last_seen] entry expired
+        """
+        if self.duration > 0 and now - entry[1] > self.duration:
+            return True
+        if self.idle_duration > 0 and now - entry[2] > self.idle_duration:
+            return True
+        return False
+
+    def _cache_put(self, session_id: str, entry: list,
+                   generation: int = None):
+        """ Add an entry to the LRU cache, unless it was read from the
+        database at a `generation` that has changed since
+        """
+        with self._lock:
+            if generation is not None and (
+                    self._read_generation() != generation or
+                    self._generation != generation):
+                return
+            self._cache[session_id] = entry
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def __setitem__(self, session_id: str, user_id: str):
+        """ Store a new session
+        """
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                         (session_id, user_id, now, now))
+        self._cache_put(session_id, [user_id, now, now])
+
+    def get(self, session_id: str, default: str = None) -> str:
+        """ User ID of a live session, refreshing its idle timer
+        """
+        now = time.time()
+        self._check_generation()
+        with self._lock:
+            entry = self._cache.get(session_id)
+            if entry is not None:
+                self._cache.move_to_end(session_id)
+        if entry is None or self._expired(entry, now):
+            # Another process may have refreshed the session
+            generation = self._read_generation()
+            row = self._connection().execute(
+                "SELECT user_id, created_at, last_seen FROM sessions "
+                "WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return default
+            entry = list(row)
+            if self._expired(entry, now):
+                self.pop(session_id)
+                return default
+            self._cache_put(session_id, entry, generation)
+        if self.idle_duration > 0 and \
+                now - entry[2] > self.touch_interval:
+            entry[2] = now
+            conn = self._connection()
+            with conn:
+                conn.execute("UPDATE sessions SET last_seen = ? "
+                             "WHERE session_id = ?", (now, session_id))
+        return entry[0]
+
+    def pop(self, session_id: str, default: str = None) -> str:
+        """ Remove a session and return its user ID if it was live
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT user_id, created_at, last_seen FROM sessions "
+                "WHERE session_id = ?", (session_id,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM sessions WHERE session_id = ?",
+                             (session_id,))
+                # Bumped while holding the write lock, so concurrent
+                # deletes from other processes are serialized
+                struct.pack_into('<Q', self._generation_map, 0,
+                                 self._read_generation() + 1)
+        with self._lock:
+            self._cache.pop(session_id, None)
+        if row is None or self._expired(list(row), time.time()):
+            return default
+        return row[0]
+
+    def __getitem__(self, session_id: str) -> str:
+        """ User ID of a live session, KeyError if there is none
+        """
+        user_id = self.get(session_id)
+        if user_id is None:
+            raise KeyError(session_id)
+        return user_id
+
+    def __delitem__(self, session_id: str):
+        """ Remove a session, KeyError if there is none
+        """
+        if self.pop(session_id) is None:
+            raise KeyError(session_id)
+
+    def __contains__(self, session_id: str) -> bool:
+        """ True if the session is live
+        """
+        return self.get(session_id) is not None
+
+    def __len__(self) -> int:
+        """ Number of stored sessions, including expired ones not yet
+        purged
+        """
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def purge(self):
+        """ Delete all expired sessions from the database
+        """
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            if self.duration > 0:
+                conn.execute("DELETE FROM sessions WHERE created_at < ?",
+                             (now - self.duration,))
+            if self.idle_duration > 0:
+                conn.execute("DELETE FROM sessions WHERE last_seen < ?",
+                             (now - self.idle_duration,))
+
+
+def _int_env(name: str, default: int) -> int:
+    """ Integer value of an environment variable
+    """
+    try:
+        return int(getenv(name, default))
+    except ValueError:
+        return default
+
+
+def session_store_from_env():
+    """ Build the session store configured by the environment:
+      - SESSION_STORE: "memory" (default) or "sqlite" to share sessions
+        between the worker processes of a host
+      - SESSION_DURATION: seconds a session lives after creation
+      - SESSION_IDLE_DURATION: seconds a session lives unused
+      - SESSION_MAX_SIZE: max number of sessions kept (LRU eviction)
+        in memory, or cached per process with sqlite
+      - SESSION_SHARDS: number of independently locked shards (memory)
+      - SESSION_DB_PATH: database file (sqlite)
+    """
+    if getenv("SESSION_STORE") == "sqlite":
+        return SQLiteSessionStore(
+            getenv("SESSION_DB_PATH", ".db_sessions.sqlite"),
+            duration=_int_env("SESSION_DURATION", 0),
+            idle_duration=_int_env("SESSION_IDLE_DURATION", 0),
+            cache_size=_int_env("SESSION_MAX_SIZE", 0) or 10000)
+    return MemorySessionStore(
+        duration=_int_env("SESSION_DURATION", 0),
+        idle_duration=_int_env("SESSION_IDLE_DURATION", 0),
+        max_size=_int_env("SESSION_MAX_SIZE", 0),
+        shards=_int_env("SESSION_SHARDS", 16))
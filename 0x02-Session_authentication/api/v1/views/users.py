@@ -1,17 +1,62 @@
 #!/usr/bin/env python3
 """ Module of Users views
 """
-from flask import jsonify, abort, request
+from flask import jsonify, abort, request, current_app, json
+from flask import stream_with_context
 from models.user import User
 from api.v1.views import app_views
 
 
+DEFAULT_PAGE_SIZE = 100
+# (User version, serialized list), replaced in one assignment so that
+# concurrent requests never pair a body with another version
+_users_response = (None, None)
+
+
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def get_users():
     """ Get all users
+    Query parameters:
+      - limit/cursor: return one page ordered by id; the cursor of the
+        next page is sent in the X-Next-Cursor header
+      - stream: emit the JSON array incrementally
+    Without them, the serialized list is kept until a User changes
     """
-    all_users = [user.to_dict() for user in User.all()]
-    return jsonify(all_users)
+    global _users_response
+    if request.args.get('stream'):
+        return current_app.response_class(
+            stream_with_context(_stream_users()), mimetype='application/json')
+    if 'limit' in request.args or 'cursor' in request.args:
+        try:
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return jsonify({"error": "Invalid limit"}), 400
+        users, next_cursor = User.page(limit, request.args.get('cursor'))
+        response = jsonify([user.to_dict() for user in users])
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    version = User.version()
+    cached_version, body = _users_response
+    if cached_version != version:
+        all_users = [user.to_dict() for user in User.all()]
+        body = jsonify(all_users).get_data()
+        _users_response = (version, body)
+    return current_app.response_class(body, mimetype='application/json')
+
+
+def _stream_users():
+    """ Yield the JSON array of all users one object at a time
+    """
+    yield '['
+    separator = ''
+    for user in User.iter_all():
+        yield separator + json.dumps(user.to_dict())
+        separator = ','
+    yield ']'
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
@@ -40,7 +85,10 @@ def create_user():
         return jsonify({"error": "Missing password"}), 400
     user_data = request.json
     user = User(**user_data)
-    user.save()
+    try:
+        user.save()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     return jsonify(user.to_dict()), 201
 
 
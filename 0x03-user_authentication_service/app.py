@@ -4,11 +4,34 @@ Flask app module
 """
 from flask import Flask, request, jsonify, abort, make_response
 from flask import redirect, url_for
+import hmac
+import os
 from auth import Auth
+from hashing import HashingSaturated
 
 
 app = Flask(__name__)
 AUTH = Auth()
+BULK_IMPORT_TOKEN = os.getenv("BULK_IMPORT_TOKEN")
+BULK_MAX_USERS = int(os.getenv("BULK_MAX_USERS", 1000))
+
+
+@app.teardown_appcontext
+def close_db_session(exception=None):
+    """
+    Release the database session at the end of each request
+    """
+    AUTH.close_session()
+
+
+@app.errorhandler(HashingSaturated)
+def hashing_saturated(error):
+    """
+    503 when the password hashing pool is full
+    """
+    response = jsonify({"message": "service busy"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
 
 
 @app.route("/", methods=["GET"])
@@ -34,6 +57,41 @@ def users():
         return jsonify({"message": "email already registered"}), 400
 
 
+@app.route("/users/bulk", methods=["POST"])
+def users_bulk():
+    """
+    POST route to register many users from a JSON list of at most
+    BULK_MAX_USERS {"email": ..., "password": ...} objects. Only
+    enabled when BULK_IMPORT_TOKEN is set, and requires the header
+    "Authorization: Bearer <BULK_IMPORT_TOKEN>".
+    """
+    if not BULK_IMPORT_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(
+            request.headers.get("Authorization", "").encode(),
+            f"Bearer {BULK_IMPORT_TOKEN}".encode()):
+        abort(401)
+    users = request.get_json(silent=True)
+    if not isinstance(users, list) or not all(
+            isinstance(user, dict) and
+            isinstance(user.get("email"), str) and
+            isinstance(user.get("password"), str) for user in users):
+        return jsonify({"message": "expected a list of users"}), 400
+    if len(users) > BULK_MAX_USERS:
+        return jsonify({"message": f"at most {BULK_MAX_USERS} users"}), 413
+
+    created = AUTH.register_users(
+        (user["email"], user["password"]) for user in users)
+    not_seen = set(created)
+    skipped = []
+    for user in users:
+        if user["email"] in not_seen:
+            not_seen.remove(user["email"])
+        else:
+            skipped.append(user["email"])
+    return jsonify({"created": created, "skipped": skipped})
+
+
 @app.route("/sessions", methods=["POST"])
 def login():
     """
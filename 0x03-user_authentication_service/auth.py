@@ -4,15 +4,20 @@ Auth module
 """
 import bcrypt
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Tuple
 from db import DB
+from hashing import HashExecutor, HashingSaturated, hash_executor_from_env
+from hashing import hash_rounds, rounds_from_env
+from session_cache import SessionCache, SessionUser, session_cache_from_env
 from user import User
 from sqlalchemy.orm.exc import NoResultFound
 
 
-def _hash_password(password: str) -> bytes:
-    """ Hash a password with bcrypt.
+def _hash_password(password: str, rounds: int = None) -> bytes:
+    """ Hash a password with bcrypt, using `rounds` as cost factor.
     """
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds) if rounds else bcrypt.gensalt()
     hashed = bcrypt.hashpw(password.encode(), salt)
     return hashed
 
@@ -27,9 +32,26 @@ class Auth:
     """
     Auth class to interact with
     the authentcation database.
+
+    bcrypt calls run on `hasher`, a bounded HashExecutor; they raise
+    hashing.HashingSaturated when it is full. Passwords are hashed with
+    `rounds` as cost factor (calibrated at startup by default), and
+    rehashed on login when their stored cost differs.
+
+    Users of session IDs are cached in `session_cache`; its stats()
+    give the hit and miss counters.
     """
-    def __init__(self):
+    def __init__(self, hasher: HashExecutor = None, rounds: int = None,
+                 session_cache: SessionCache = None):
         self._db = DB()
+        self._hasher = hasher or hash_executor_from_env()
+        self._rounds = rounds or rounds_from_env()
+        self.session_cache = session_cache or session_cache_from_env()
+
+    def close_session(self) -> None:
+        """ Release the database session of the current request.
+        """
+        self._db.remove_session()
 
     def register_user(self, email: str, password: str) -> User:
         """
@@ -39,76 +61,134 @@ class Auth:
             self._db.find_user_by(email=email)
             raise ValueError(f"User {email} already exists")
         except NoResultFound:
-            hashed_password = _hash_password(password)
+            hashed_password = self._hasher.run("hash", _hash_password,
+                                               password, self._rounds)
             return self._db.add_user(email, hashed_password.decode('utf-8'))
 
+    def register_users(self, users: Iterable[Tuple[str, str]]) -> List[str]:
+        """
+        Register many (email, password) pairs at once. Emails already
+        registered, repeated or registered concurrently are skipped.
+        Passwords are hashed on the request hashing pool, using at most
+        half of its workers so that logins keep the rest. Returns the
+        registered emails.
+        """
+        passwords = {}
+        for email, password in users:
+            passwords.setdefault(email, password)
+        for email in self._db.existing_emails(passwords):
+            del passwords[email]
+        emails = list(passwords)
+        workers = max(1, self._hasher.workers // 2)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            hashes = list(pool.map(self._bulk_hash,
+                                   (passwords[email] for email in emails)))
+        return self._db.add_users([
+            (email, hashed.decode('utf-8'))
+            for email, hashed in zip(emails, hashes)])
+
+    def _bulk_hash(self, password: str) -> bytes:
+        """ Hash a password on the hashing pool, waiting for a free
+        slot instead of failing.
+        """
+        return self._hasher.run("bulk_hash", _hash_password,
+                                password, self._rounds, timeout=None)
+
     def valid_login(self, email: str, password: str) -> bool:
         """ Validate login credentials.
         """
         try:
             user = self._db.find_user_by(email=email)
-            if bcrypt.checkpw(password.encode(),
-                              user.hashed_password.encode()):
+            if self._hasher.run("check", bcrypt.checkpw, password.encode(),
+                                user.hashed_password.encode()):
+                self._rehash_if_needed(user, password)
                 return True
             else:
                 return False
         except NoResultFound:
             return False
 
+    def _rehash_if_needed(self, user: User, password: str) -> None:
+        """ Rehash a verified password stored with another cost factor,
+        unless the hashing pool is full: the login still succeeds.
+        """
+        if hash_rounds(user.hashed_password.encode()) == self._rounds:
+            return
+        try:
+            hashed_password = self._hasher.run("hash", _hash_password,
+                                               password, self._rounds)
+        except HashingSaturated:
+            return
+        self._db.update_user(user.id,
+                             hashed_password=hashed_password.decode('utf-8'))
+
     def create_session(self, email: str) -> str:
         """ Create a new session for a user.
         """
-        try:
-            user = self._db.find_user_by(email=email)
-            session_id = _generate_uuid()
-            self._db.update_user(user.id, session_id=session_id)
-            return session_id
-        except NoResultFound:
+        session_id = _generate_uuid()
+        count = self._db.update_users_by({"email": email},
+                                         session_id=session_id)
+        self.session_cache.invalidate(email=email)
+        if count == 0:
             return None
+        return session_id
 
-    def get_user_from_session_id(self, session_id: str) -> User:
-        """ Get a user from a session ID.
+    def get_user_from_session_id(self, session_id: str) -> SessionUser:
+        """ Get the id and email of the user of a session ID.
         """
         if session_id is None:
             return None
 
+        user = self.session_cache.get(session_id)
+        if user is not None:
+            return user
+        generation = self.session_cache.generation()
         try:
             user = self._db.find_user_by(session_id=session_id)
-            return user
         except NoResultFound:
             return None
+        user = SessionUser(user.id, user.email)
+        self.session_cache.put(session_id, user, generation)
+        return user
 
     def destroy_session(self, user_id: int) -> None:
         """ Destroy a user's session
         """
         try:
-            user = self._db.find_user_by(id=user_id)
-            self._db.update_user(user.id, session_id=None)
+            self._db.update_user(user_id, session_id=None)
         except NoResultFound:
             return None
+        finally:
+            self.session_cache.invalidate(user_id=user_id)
 
     def get_reset_password_token(self, email: str) -> str:
         """ Get a reset password token for a user.
         """
-        try:
-            user = self._db.find_user_by(email=email)
-        except NoResultFound:
-            raise ValueError(f"User {email} does not exist")
-
         reset_token = _generate_uuid()
-        self._db.update_user(user.id, reset_token=reset_token)
+        if self._db.update_users_by({"email": email},
+                                    reset_token=reset_token) == 0:
+            raise ValueError(f"User {email} does not exist")
         return reset_token
 
     def update_password(self, reset_token: str, password: str) -> None:
         """
         Update a user's password using a reset token
         """
+        if not reset_token:
+            raise ValueError("Invalid reset token")
+        # Checked first so that invalid tokens don't cost a hash
         try:
-            user = self._db.find_user_by(reset_token=reset_token)
+            self._db.find_user_by(reset_token=reset_token)
         except NoResultFound:
             raise ValueError("Invalid reset token")
 
-        hashed_password = _hash_password(password)
-        self._db.update_user(user.id,
-                             hashed_password=hashed_password.decode('utf-8'),
-                             reset_token=None)
+        hashed_password = self._hasher.run("hash", _hash_password,
+                                           password, self._rounds)
+        if self._db.update_users_by(
+                {"reset_token": reset_token},
+                hashed_password=hashed_password.decode('utf-8'),
+                reset_token=None) == 0:
+            raise ValueError("Invalid reset token")
+        # The user isn't known here without another query, and
+        # password changes are rare enough to drop the whole cache
+        self.session_cache.clear()
@@ -1,36 +1,90 @@
 #!/usr/bin/env python3
 """DB module
 """
-from sqlalchemy import create_engine
+import os
+from typing import Iterable, List, Set, Tuple
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.orm.session import Session
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
 from sqlalchemy.orm.exc import NoResultFound
 
 from user import Base, User
 
 
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """Tune each new SQLite connection for concurrent reads
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
 class DB:
     """DB class
+
+    The database URL comes from DB_URL (default sqlite:///a.db). Existing
+    data is kept and only missing tables and indexes are created, unless
+    DB_PERSISTENT=0, which drops the schema first.
+
+    Each thread (hence each request) gets its own session from a
+    scoped_session, released by remove_session(). Connections come
+    from a pool sized by DB_POOL_SIZE and DB_MAX_OVERFLOW and checked
+    before use. An in-memory SQLite database (DB_URL=sqlite://) lives
+    in a single connection shared by all threads instead.
     """
 
     def __init__(self) -> None:
         """Initialize a new DB instance
         """
-        self._engine = create_engine("sqlite:///a.db", echo=False)
-        Base.metadata.drop_all(self._engine)
+        url = make_url(os.getenv("DB_URL", "sqlite:///a.db"))
+        connect_args = {}
+        pool_args = {
+            "poolclass": QueuePool,
+            "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+            "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+            "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", 30)),
+            "pool_pre_ping": True,
+        }
+        if url.get_backend_name() == "sqlite":
+            connect_args["check_same_thread"] = False
+            if url.database in (None, "", ":memory:"):
+                # Each new connection would be a new, empty database
+                pool_args = {"poolclass": StaticPool}
+        self._engine = create_engine(
+            url, echo=False, connect_args=connect_args, **pool_args)
+        if self._engine.dialect.name == "sqlite":
+            event.listen(self._engine, "connect", _set_sqlite_pragmas)
+        if os.getenv("DB_PERSISTENT", "1") == "0":
+            Base.metadata.drop_all(self._engine)
         Base.metadata.create_all(self._engine)
-        self.__session = None
+        for index in User.__table__.indexes:
+            index.create(self._engine, checkfirst=True)
+        self.__sessions = scoped_session(sessionmaker(bind=self._engine))
 
     @property
     def _session(self) -> Session:
-        """Memoized session object
+        """Session of the current thread
         """
-        if self.__session is None:
-            DBSession = sessionmaker(bind=self._engine)
-            self.__session = DBSession()
-        return self.__session
+        return self.__sessions()
+
+    def remove_session(self) -> None:
+        """Close the session of the current thread and return its
+        connection to the pool
+        """
+        self.__sessions.remove()
 
     def add_user(self, email: str, hashed_password: str) -> User:
         """
@@ -42,6 +96,49 @@ class DB:
         self._session.commit()
         return user
 
+    def add_users(self, users: List[Tuple[str, str]],
+                  batch_size: int = 1000) -> List[str]:
+        """
+        Insert (email, hashed_password) pairs with one multi-row
+        INSERT and one commit per batch. A batch hitting an email
+        registered concurrently is rolled back and retried without it.
+        Returns the emails inserted.
+        """
+        inserted = []
+        for start in range(0, len(users), batch_size):
+            batch = users[start:start + batch_size]
+            while batch:
+                try:
+                    self._session.bulk_insert_mappings(User, [
+                        {"email": email, "hashed_password": hashed_password}
+                        for email, hashed_password in batch])
+                    self._session.commit()
+                except IntegrityError:
+                    self._session.rollback()
+                    taken = self.existing_emails(
+                        email for email, _ in batch)
+                    if not taken:
+                        raise
+                    batch = [user for user in batch if user[0] not in taken]
+                    continue
+                inserted.extend(email for email, _ in batch)
+                break
+        return inserted
+
+    def existing_emails(self, emails: Iterable[str],
+                        chunk_size: int = 500) -> Set[str]:
+        """
+        Emails among the given ones that already belong to a user, in
+        one IN query per chunk (bound parameters are limited).
+        """
+        emails = list(emails)
+        found = set()
+        for start in range(0, len(emails), chunk_size):
+            rows = self._session.query(User.email).filter(
+                User.email.in_(emails[start:start + chunk_size]))
+            found.update(email for email, in rows)
+        return found
+
     def find_user_by(self, **kwargs) -> User:
         """
         Find a user by arbitrary keyword arguments.
@@ -63,9 +160,25 @@ class DB:
         """
         Update a user's attributes.
         """
-        user = self.find_user_by(id=user_id)
-        for key, value in kwargs.items():
-            if not hasattr(user, key):
+        if self.update_users_by({"id": user_id}, **kwargs) == 0:
+            raise NoResultFound("No user found with the provided arguments.")
+
+    def update_users_by(self, filters: dict, **kwargs) -> int:
+        """
+        Set attributes of the users matching filters in a single
+        UPDATE ... WHERE statement, without loading them first.
+        Returns the number of matched users. None filter values are
+        refused: they would match every user whose column IS NULL.
+        """
+        columns = User.__table__.columns.keys()
+        for key in list(filters) + list(kwargs):
+            if key not in columns:
                 raise ValueError(f"Attribute {key} does not exist on User")
-            setattr(user, key, value)
+        for key, value in filters.items():
+            if value is None:
+                raise ValueError(f"Cannot update users by {key}=None")
+        if not filters or not kwargs:
+            raise InvalidRequestError("No arguments provided for update.")
+        count = self._session.query(User).filter_by(**filters).update(kwargs)
         self._session.commit()
+        return count
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Hashing module: runs bcrypt calls on a bounded thread pool and picks
+the bcrypt cost factor
+"""
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import Callable
+
+import bcrypt
+
+
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+CALIBRATION_SAMPLES = 5
+
+
+class HashingSaturated(Exception):
+    """
+    Raised when the hashing pool has no free worker or queue slot.
+    """
+
+
+class HashExecutor:
+    """
+    Thread pool for bcrypt calls. bcrypt releases the GIL, so up to
+    `workers` hashes run in parallel while at most `queue_size` more
+    wait; further calls fail fast with HashingSaturated instead of
+    piling up on request threads.
+    """
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="bcrypt")
+        self._slots = BoundedSemaphore(workers + queue_size)
+        self._lock = Lock()
+        self._metrics = {}
+
+    def run(self, name: str, func: Callable, *args, timeout: float = 0):
+        """
+        Run func(*args) on the pool and return its result, recording
+        the call under `name` in the metrics. A full pool fails fast by
+        default; with `timeout` the call waits that many seconds for a
+        slot (None: as long as needed).
+        """
+        if timeout == 0:
+            acquired = self._slots.acquire(blocking=False)
+        else:
+            acquired = self._slots.acquire(timeout=timeout)
+        if not acquired:
+            self._record(name, None)
+            raise HashingSaturated(f"Hashing pool saturated ({name})")
+        start = time.monotonic()
+        try:
+            future = self._pool.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result()
+        finally:
+            self._record(name, time.monotonic() - start)
+
+    def _record(self, name: str, duration: float) -> None:
+        """ Update the metrics of one call, None meaning rejected.
+        """
+        with self._lock:
+            metric = self._metrics.setdefault(name, {
+                "calls": 0, "rejected": 0, "total_seconds": 0.0,
+                "max_seconds": 0.0})
+            if duration is None:
+                metric["rejected"] += 1
+                return
+            metric["calls"] += 1
+            metric["total_seconds"] += duration
+            metric["max_seconds"] = max(metric["max_seconds"], duration)
+
+    def metrics(self) -> dict:
+        """ Copy of the per-operation call metrics.
+        """
+        with self._lock:
+            return {name: dict(metric)
+                    for name, metric in self._metrics.items()}
+
+
+def calibrate_rounds(target_ms: float, min_rounds: int = MIN_ROUNDS,
+                     max_rounds: int = MAX_ROUNDS) -> int:
+    """
+    Highest bcrypt cost factor whose hash takes at most target_ms on
+    this host, within [min_rounds, max_rounds]. Each extra round
+    doubles the work, so a cheap measurement is extrapolated; the
+    fastest of CALIBRATION_SAMPLES runs after a warm-up is used, so that
+    workers started together agree. Set BCRYPT_ROUNDS in production to
+    pin the cost factor.
+    """
+    probe_rounds = 6
+    salt = bcrypt.gensalt(rounds=probe_rounds)
+    bcrypt.hashpw(b"calibration", salt)
+    samples = []
+    for _ in range(CALIBRATION_SAMPLES):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", salt)
+        samples.append(time.perf_counter() - start)
+    elapsed_ms = max(min(samples) * 1000, 1e-3)
+    rounds = probe_rounds + math.floor(math.log2(target_ms / elapsed_ms))
+    return max(min_rounds, min(max_rounds, rounds))
+
+
+def rounds_from_env() -> int:
+    """
+    bcrypt cost factor from BCRYPT_ROUNDS, or calibrated to a hash
+    latency of BCRYPT_TARGET_MS (default 50) milliseconds.
+    """
+    if os.getenv("BCRYPT_ROUNDS"):
+        return int(os.getenv("BCRYPT_ROUNDS"))
+    return calibrate_rounds(float(os.getenv("BCRYPT_TARGET_MS", 50)))
+
+
+def hash_rounds(hashed_password: bytes) -> int:
+    """ Cost factor of a bcrypt hash ($2b$<rounds>$...).
+    """
+    return int(hashed_password.split(b"$")[2])
+
+
+def hash_executor_from_env() -> HashExecutor:
+    """
+    Build a HashExecutor configured by HASH_WORKERS (default: number of
+    CPUs) and HASH_QUEUE_SIZE (default: 4 per worker).
+    """
+    workers = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+    queue_size = int(os.getenv("HASH_QUEUE_SIZE", workers * 4))
+    return HashExecutor(workers, queue_size)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Session cache module
+"""
+import os
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+
+SessionUser = namedtuple("SessionUser", ["id", "email"])
+
+
+class SessionCache:
+    """
+    LRU cache from session IDs to SessionUser projections, holding up
+    to `max_size` entries for `ttl` seconds each. Hits and misses are
+    counted in stats().
+
+    Every invalidation bumps a generation counter and records it for
+    the user. A caller filling the cache takes generation() before
+    reading the database and passes it to put(), which skips the entry
+    if the user was invalidated meanwhile (e.g. by a logout).
+    """
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._by_email = {}
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._floor = 0
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, session_id: str) -> SessionUser:
+        """ Cached user of a session ID, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    self._drop(session_id)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self._hits += 1
+            return entry[0]
+
+    def generation(self) -> int:
+        """ Current invalidation generation, to pass to put().
+        """
+        with self._lock:
+            return self._generation
+
+    def put(self, session_id: str, user: SessionUser,
+            generation: int = None) -> None:
+        """ Cache the user of a session ID, read from the database at
+        `generation`; skipped if the user was invalidated since.
+        """
+        with self._lock:
+            if generation is not None and (
+                    self._floor > generation or
+                    self._invalidated.get(("id", user.id), 0) > generation or
+                    self._invalidated.get(("email", user.email), 0) >
+                    generation):
+                return
+            self._drop(self._by_user.get(user.id))
+            self._entries[session_id] = (user, time.monotonic() + self.ttl)
+            self._by_user[user.id] = session_id
+            self._by_email[user.email] = session_id
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, user_id: int = None, email: str = None) -> None:
+        """ Drop the cached session of a user, by ID or email.
+        """
+        with self._lock:
+            self._generation += 1
+            for key in (("id", user_id), ("email", email)):
+                if key[1] is not None:
+                    self._invalidated[key] = self._generation
+                    self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.max_size:
+                # Forgetting a user is safe: put() then skips everyone
+                # read before that invalidation
+                self._floor = self._invalidated.popitem(last=False)[1]
+            self._drop(self._by_user.get(user_id))
+            self._drop(self._by_email.get(email))
+
+    def clear(self) -> None:
+        """ Drop all cached sessions.
+        """
+        with self._lock:
+            self._generation += 1
+            self._floor = self._generation
+            self._invalidated.clear()
+            self._entries.clear()
+            self._by_user.clear()
+            self._by_email.clear()
+
+    def stats(self) -> dict:
+        """ Hit and miss counters and current size.
+        """
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses,
+                    "size": len(self._entries)}
+
+    def _drop(self, session_id: str) -> None:
+        """ Remove an entry and its reverse mappings; lock held.
+        """
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return
+        user = entry[0]
+        if self._by_user.get(user.id) == session_id:
+            del self._by_user[user.id]
+        if self._by_email.get(user.email) == session_id:
+            del self._by_email[user.email]
+
+
+def session_cache_from_env() -> SessionCache:
+    """
+    Build a SessionCache configured by SESSION_CACHE_SIZE (default
+    10000) and SESSION_CACHE_TTL (default 60 seconds).
+    """
+    return SessionCache(int(os.getenv("SESSION_CACHE_SIZE", 10000)),
+                        float(os.getenv("SESSION_CACHE_TTL", 60)))
@@ -12,11 +12,13 @@ Base = declarative_base()
 class User(Base):
     """
     SQLAlchemy model for the 'users' table.
+    email and session_id have unique indexes and reset_token an index,
+    since every Auth lookup filters on one of them.
     """
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, unique=True, index=True)
     hashed_password = Column(String(250), nullable=False)
-    session_id = Column(String(250), nullable=True)
-    reset_token = Column(String(250), nullable=True)
+    session_id = Column(String(250), nullable=True, unique=True, index=True)
+    reset_token = Column(String(250), nullable=True, index=True)